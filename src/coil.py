@@ -3,7 +3,7 @@ from itertools import pairwise
 
 from KicadModTree.Vector import Vector2D
 
-from constants import magnitude, normalized
+from constants import COPPER_RESISTIVITY, DFLT_TRACE_HEIGHT, magnitude, normalized
 
 import numpy as np
 from magpylib import Collection, current
@@ -20,7 +20,7 @@ class Coil(object):
         self.trace_width = desc['trace_width'] / 1000
         self.base = desc['base']
         self.turns = desc['turns'] if self.base == 'inner' else desc['turns']
-        self.trace_height = desc['trace_height'] / 1000 if 'trace_height' in desc else 34.1 / 1_000_000
+        self.trace_height = desc['trace_height'] / 1000 if 'trace_height' in desc else DFLT_TRACE_HEIGHT
 
         if 'current' in desc:
             self.current: float = desc['current']
@@ -96,17 +96,18 @@ class Coil(object):
 
         self.length = sum(magnitude(v2 - v1) for v1, v2 in pairwise(self.verts)) * self.layers
         
-        p_cu = 1.724e-8
-        self.resistance = p_cu * (self.length / (self.trace_width * self.trace_height))
+        self.resistance = COPPER_RESISTIVITY * (self.length / (self.trace_width * self.trace_height))
 
         if 'current' not in desc:
             self.current: float = np.sqrt(desc['power'] / self.resistance)
 
     # Get a magpylib simulation model for this coil 
-    def simulation_model(self):
+    # Optional per-layer (x, y) offsets in meters model misregistration between PCB layers
+    def simulation_model(self, layer_offsets = None):
         sim_verts = []
         for i in range(self.layers):
-            layer = [(v[0], i * -self.spacing, v[1]) for v in self.verts]
+            offset = layer_offsets[i] if layer_offsets is not None else (0, 0)
+            layer = [(v[0] + offset[0], i * -self.spacing, v[1] + offset[1]) for v in self.verts]
             sim_verts.extend(layer)
         return current.Polyline(position=(0,0,0), vertices=sim_verts, current=self.current)
     
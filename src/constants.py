@@ -3,6 +3,11 @@ from numpy.typing import NDArray
 
 CHESS_SQUARE_SIZE: float = 38 / 1000
 
+# Copper thickness in meters used when a coil does not give a trace height, 1oz copper
+DFLT_TRACE_HEIGHT: float = 34.1 / 1_000_000
+# Resistivity of copper in ohm meters
+COPPER_RESISTIVITY: float = 1.724e-8
+
 # Get the magnitude of the given vector
 def magnitude(vec):
     return np.sqrt(np.sum(vec ** 2))
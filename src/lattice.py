@@ -0,0 +1,216 @@
+
+# Precomputed magnetic field lattice for fast repeated field queries
+
+import hashlib
+import json
+import os
+from typing import Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+from coil import Coil
+from constants import CHESS_SQUARE_SIZE
+from report import DFLT_OBSERVER_HEIGHT
+
+INTERP_LINEAR = 'linear'
+INTERP_CUBIC = 'cubic'
+
+DFLT_LATTICE_RESOLUTION = (64, 16, 64)
+DFLT_LATTICE_LOWER = (-CHESS_SQUARE_SIZE, 1 / 1000, -CHESS_SQUARE_SIZE)
+DFLT_LATTICE_UPPER = (CHESS_SQUARE_SIZE, 2 * DFLT_OBSERVER_HEIGHT, CHESS_SQUARE_SIZE)
+
+# Number of observer points passed to magpylib in a single call while building a lattice
+BUILD_CHUNK_SIZE = 4096
+# Number of query points interpolated at once, bounds the size of the gathered neighbourhoods
+QUERY_CHUNK_SIZE = 65536
+# Number of random points checked against the exact field when estimating interpolation error, the largest errors sit
+# in small pockets close to the traces so too few samples understate the maximum
+ERROR_SAMPLES = 16384
+
+# Get a hash identifying the field produced by the given coil, used to share lattices between identical coils
+def coil_fingerprint(coil: Coil) -> str:
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(coil.verts, dtype=np.float64).tobytes())
+    digest.update(np.array([coil.layers, coil.spacing, coil.current], dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+# Get the fewest lattice points per axis that the given interpolation method needs
+def min_resolution(method: str) -> int:
+    return 4 if method == INTERP_CUBIC else 2
+
+# Raise a ValueError if a lattice resolution has too few points on any axis for the given interpolation method
+def check_resolution(resolution, method: str = INTERP_LINEAR) -> None:
+    if any(n < min_resolution(method) for n in resolution):
+        raise ValueError(f'Lattice resolution {tuple(int(n) for n in resolution)} needs at least {min_resolution(method)} points per axis for {method} interpolation')
+
+# Get interpolation weights along one axis for fractional lattice offsets t in [0, 1)
+# Returns the index offset of the first neighbour and an (N, K) array of weights for K neighbours
+def _axis_weights(t: NDArray, method: str) -> tuple[int, NDArray]:
+    if method == INTERP_LINEAR:
+        return 0, np.stack([1 - t, t], axis=-1)
+    elif method == INTERP_CUBIC:
+        # Catmull-Rom spline weights
+        t2 = t * t
+        t3 = t2 * t
+        return -1, np.stack([
+            0.5 * (-t3 + 2 * t2 - t),
+            0.5 * (3 * t3 - 5 * t2 + 2),
+            0.5 * (-3 * t3 + 4 * t2 + t),
+            0.5 * (t3 - t2),
+        ], axis=-1)
+    else:
+        raise ValueError(f'Unknown interpolation method \'{method}\'')
+
+# B field sampled on a regular 3D grid in the coil's simulation frame, queried by interpolation
+# Axes are (x, y, z) in meters with y being height above the coil, matching the frame of `DiscreteFieldReport`
+class FieldLattice(object):
+    def __init__(
+            self,
+            B: NDArray,
+            lower,
+            upper,
+            errors: Optional[dict[str, dict[str, float]]] = None,
+        ) -> None:
+        check_resolution(B.shape[:3])
+        self.B = B
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.shape = np.array(B.shape[:3])
+        self.step = (self.upper - self.lower) / (self.shape - 1)
+        # Maximum and RMS interpolation error for each interpolation method, see `estimate_error`
+        self.errors = errors if errors is not None else {}
+
+    # Simulate the field of a coil at every point of a new lattice
+    @classmethod
+    def build(
+            cls,
+            coil: Coil,
+            lower = DFLT_LATTICE_LOWER,
+            upper = DFLT_LATTICE_UPPER,
+            resolution = DFLT_LATTICE_RESOLUTION,
+        ) -> 'FieldLattice':
+        check_resolution(resolution)
+        model = coil.simulation_model()
+        axes = [np.linspace(lo, hi, n) for lo, hi, n in zip(lower, upper, resolution)]
+        points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        B = np.empty((len(points), 3), dtype=np.float32)
+        for start in range(0, len(points), BUILD_CHUNK_SIZE):
+            B[start:start + BUILD_CHUNK_SIZE] = model.getB(points[start:start + BUILD_CHUNK_SIZE])
+
+        lattice = cls(B.reshape(*resolution, 3), lower, upper)
+        lattice.estimate_error(model)
+        return lattice
+
+    # Load a lattice for the given coil from a cache directory, building and storing it if not present
+    # Coils producing the same field (e.g. every square of a board) share one cached lattice
+    @classmethod
+    def cached(
+            cls,
+            coil: Coil,
+            cache_dir: str,
+            lower = DFLT_LATTICE_LOWER,
+            upper = DFLT_LATTICE_UPPER,
+            resolution = DFLT_LATTICE_RESOLUTION,
+        ) -> 'FieldLattice':
+        key = hashlib.sha256(repr((
+            coil_fingerprint(coil),
+            tuple(float(v) for v in lower),
+            tuple(float(v) for v in upper),
+            tuple(int(v) for v in resolution),
+        )).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, f'lattice-{key}')
+
+        if os.path.exists(path + '.npy') and os.path.exists(path + '.json'):
+            return cls.load(path)
+
+        lattice = cls.build(coil, lower, upper, resolution)
+        os.makedirs(cache_dir, exist_ok=True)
+        lattice.save(path)
+        return lattice
+
+    # Write the lattice to `<path>.npy` (raw float32 field values) and `<path>.json` (grid metadata)
+    def save(self, path: str) -> None:
+        np.save(path + '.npy', np.asarray(self.B, dtype=np.float32))
+        with open(path + '.json', 'w+') as meta:
+            json.dump({
+                'lower': self.lower.tolist(),
+                'upper': self.upper.tolist(),
+                'errors': self.errors,
+            }, meta, indent=4)
+
+    # Read a lattice written by `save`, memory-mapping the field values rather than loading them
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'FieldLattice':
+        B = np.load(path + '.npy', mmap_mode='r' if mmap else None)
+        with open(path + '.json') as meta:
+            desc = json.load(meta)
+        return cls(
+            B,
+            desc['lower'],
+            desc['upper'],
+            errors=desc.get('errors', {}),
+        )
+
+    # Get a boolean mask of which of an (N, 3) array of positions lie within the lattice
+    def contains(self, positions) -> NDArray:
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+        return np.all((positions >= self.lower) & (positions <= self.upper), axis=-1)
+
+    # Interpolate the B field at an (N, 3) array of positions, returning an (N, 3) array in Tesla
+    # Positions outside the lattice are clamped to its boundary, use `contains` to find them
+    def interpolate(self, positions, method: str = INTERP_CUBIC) -> NDArray:
+        check_resolution(self.shape, method)
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+        out = np.empty((len(positions), 3), dtype=np.float64)
+        for start in range(0, len(positions), QUERY_CHUNK_SIZE):
+            chunk = positions[start:start + QUERY_CHUNK_SIZE]
+            out[start:start + QUERY_CHUNK_SIZE] = self._interpolate_chunk(chunk, method)
+        return out
+
+    def _interpolate_chunk(self, positions: NDArray, method: str) -> NDArray:
+        coords = (positions - self.lower) / self.step
+        coords = np.clip(coords, 0, self.shape - 1)
+        base = np.minimum(np.floor(coords).astype(np.intp), self.shape - 2)
+        frac = coords - base
+
+        indices = []
+        weights = []
+        for axis in range(3):
+            offset, w = _axis_weights(frac[:, axis], method)
+            idx = base[:, axis, None] + offset + np.arange(w.shape[1])
+            indices.append(np.clip(idx, 0, self.shape[axis] - 1))
+            weights.append(w)
+
+        # Gather the (N, K, K, K, 3) neighbourhood of every point and contract it with the per-axis weights
+        neighbours = self.B[
+            indices[0][:, :, None, None],
+            indices[1][:, None, :, None],
+            indices[2][:, None, None, :],
+        ]
+        return np.einsum('na,nb,nc,nabcd->nd', weights[0], weights[1], weights[2], neighbours)
+
+    # Compare interpolated values against the exact field at random points inside the lattice
+    # Absolute errors are in Tesla, relative errors are against the exact field magnitude at each sampled point
+    def estimate_error(self, model, samples: int = ERROR_SAMPLES) -> dict[str, dict[str, float]]:
+        rng = np.random.default_rng(0)
+        points = rng.uniform(self.lower, self.upper, size=(samples, 3))
+        exact = np.concatenate([
+            model.getB(points[start:start + BUILD_CHUNK_SIZE])
+            for start in range(0, samples, BUILD_CHUNK_SIZE)
+        ])
+        local = np.linalg.norm(exact, axis=-1)
+
+        for method in (INTERP_LINEAR, INTERP_CUBIC):
+            if np.any(self.shape < min_resolution(method)):
+                continue
+            diff = np.linalg.norm(self.interpolate(points, method) - exact, axis=-1)
+            relative = np.divide(diff, local, out=np.full_like(diff, np.inf), where=local > 0)
+            self.errors[method] = {
+                'max_abs': float(np.max(diff)),
+                'rms_abs': float(np.sqrt(np.mean(diff ** 2))),
+                'max_rel': float(np.max(relative)),
+                'rms_rel': float(np.sqrt(np.mean(relative ** 2))),
+            }
+        return self.errors
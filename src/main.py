@@ -1,7 +1,9 @@
 from argparse import ArgumentParser
+from collections import Counter
 from copy import deepcopy
 from enum import StrEnum
 import json
+import sys
 from KicadModTree import KicadFileHandler
 import matplotlib
 import matplotlib.pyplot as plt
@@ -9,6 +11,9 @@ import numpy as np
 
 from plot import plot_field_contour, plot_report
 from report import DiscreteFieldReport, FullFieldReport
+from lattice import DFLT_LATTICE_RESOLUTION, INTERP_CUBIC, INTERP_LINEAR, FieldLattice, check_resolution
+from validity import REASON_DEGENERATE, ValidityReport
+from tolerance import OUTPUTS, PARAMS, ToleranceReport, Tolerances
 from constants import magnitude
 from coil import Coil
 
@@ -150,6 +155,134 @@ optimize.add_argument(
     help = 'Number of steps to take between the lower and upper bound'
 )
 
+optimize.add_argument(
+    '--spacing-tolerance',
+    dest = 'spacing_tolerance',
+    default = 0.0,
+    type = float,
+    help = 'Extra fraction of the spacing that gaps between turns may fall short by when screening candidates',
+)
+
+lattice = cmds.add_parser(
+    'lattice',
+    help = 'Interpolate the field at each point of a CSV file from a precomputed field lattice',
+)
+
+lattice.add_argument(
+    'points',
+    type = str,
+    help = 'CSV file of x,y,z query positions in mm, with y being the height above the coil',
+)
+
+lattice.add_argument(
+    '-o',
+    '--output',
+    dest = 'output',
+    default = None,
+    help = 'Path to write a CSV of x,y,z (mm) and Bx,By,Bz (mT) to, printed if not given',
+)
+
+lattice.add_argument(
+    '-c',
+    '--cache',
+    dest = 'cache',
+    default = None,
+    help = 'Directory to load the lattice from or store it in, shared between identical coils',
+)
+
+lattice.add_argument(
+    '-m',
+    '--method',
+    dest = 'method',
+    default = INTERP_CUBIC,
+    choices = [INTERP_LINEAR, INTERP_CUBIC],
+    help = 'Interpolation method used between lattice points',
+)
+
+lattice.add_argument(
+    '-r',
+    '--resolution',
+    dest = 'resolution',
+    type = int,
+    nargs = 3,
+    default = DFLT_LATTICE_RESOLUTION,
+    help = 'Number of lattice points along the x, y, and z axes',
+)
+
+tolerance = cmds.add_parser(
+    'tolerance',
+    help = 'Estimate the spread of field strengths over randomly perturbed copies of a design with a Monte Carlo simulation',
+)
+
+tolerance.add_argument(
+    '-n',
+    '--samples',
+    dest = 'samples',
+    type = int,
+    default = 1000,
+    help = 'Number of perturbed coils to simulate',
+)
+
+tolerance.add_argument(
+    '--trace-width-tol',
+    dest = 'trace_width_tol',
+    type = float,
+    default = Tolerances().trace_width,
+    help = 'Standard deviation of the etched trace width in mm, spacing shrinks by the same amount as the pitch is fixed',
+)
+
+tolerance.add_argument(
+    '--trace-height-tol',
+    dest = 'trace_height_tol',
+    type = float,
+    default = Tolerances().trace_height,
+    help = 'Standard deviation of the copper thickness in mm',
+)
+
+tolerance.add_argument(
+    '--registration-tol',
+    dest = 'registration_tol',
+    type = float,
+    default = Tolerances().registration,
+    help = 'Standard deviation of each layer\'s X and Y misregistration in mm',
+)
+
+tolerance.add_argument(
+    '-p',
+    '--percentiles',
+    dest = 'percentiles',
+    type = float,
+    nargs = '+',
+    default = [5, 50, 95],
+    help = 'Percentiles of each field strength to report',
+)
+
+tolerance.add_argument(
+    '-j',
+    '--jobs',
+    dest = 'jobs',
+    type = int,
+    default = None,
+    help = 'Number of worker processes, defaults to the number of CPUs',
+)
+
+tolerance.add_argument(
+    '-b',
+    '--batch-size',
+    dest = 'batch_size',
+    type = int,
+    default = 100,
+    help = 'Number of coils simulated together in one field computation',
+)
+
+tolerance.add_argument(
+    '--seed',
+    dest = 'seed',
+    type = int,
+    default = None,
+    help = 'Random seed for reproducible samples',
+)
+
 def print_discrete_report(coil, field):
     print(
     f"""
@@ -200,20 +333,114 @@ if __name__ == '__main__':
             Coil(json.load(open(args.file))).simulation_model().show()
         case 'export':
             coil = Coil(json.load(open(args.file)))
+            validity = ValidityReport(coil)
+            if validity.fatal:
+                print(f'ERROR: Refusing to export invalid coil {coil.name}:')
+                for line in validity.describe():
+                    print(f'    {line}')
+                sys.exit(1)
+            elif not validity.valid:
+                print(f'WARNING: Coil {coil.name} has traces closer than the given spacing ({", ".join(validity.describe())})')
+
             module = coil.kicad_model(args.layer)
 
             file_handler = KicadFileHandler(module)
             file_handler.writeFile(args.output)
 
+        case 'lattice':
+            try:
+                check_resolution(args.resolution, args.method)
+            except ValueError as e:
+                parser.error(str(e))
+
+            coil = Coil(json.load(open(args.file)))
+            if args.cache is not None:
+                field = FieldLattice.cached(coil, args.cache, resolution = args.resolution)
+            else:
+                field = FieldLattice.build(coil, resolution = args.resolution)
+
+            if args.method in field.errors:
+                err = field.errors[args.method]
+                print(
+                    f'Lattice interpolation error: {err["max_abs"] * 1000:.6f} mT max, {err["rms_abs"] * 1000:.6f} mT RMS, '
+                    f'{err["max_rel"] * 100:.4f}% max, {err["rms_rel"] * 100:.4f}% RMS of the local field',
+                    file = sys.stderr,
+                )
+
+            # Skip a header row such as the one written by this command, so its output can be read back in
+            with open(args.points) as csv:
+                first = csv.readline().split(',')[0].strip()
+            try:
+                float(first)
+                header_rows = 0
+            except ValueError:
+                header_rows = 1
+
+            points = np.loadtxt(args.points, delimiter = ',', ndmin = 2, skiprows = header_rows, usecols = (0, 1, 2)) / 1000
+
+            outside = ~field.contains(points)
+            if np.any(outside):
+                lo = field.lower * 1000
+                hi = field.upper * 1000
+                print(
+                    f'WARNING: {np.count_nonzero(outside)} of {len(points)} points lie outside the lattice '
+                    f'({lo[0]:.1f}..{hi[0]:.1f}, {lo[1]:.1f}..{hi[1]:.1f}, {lo[2]:.1f}..{hi[2]:.1f} mm) and were clamped to its edge',
+                    file = sys.stderr,
+                )
+
+            B = field.interpolate(points, method = args.method)
+
+            np.savetxt(
+                args.output if args.output is not None else sys.stdout,
+                np.hstack([points * 1000, B * 1000]),
+                delimiter = ',',
+                fmt = '%.6f',
+                header = 'x,y,z,Bx,By,Bz',
+                comments = '',
+            )
+
+        case 'tolerance':
+            desc = json.load(open(args.file))
+            coil = Coil(desc)
+            tolerances = Tolerances(
+                trace_width = args.trace_width_tol,
+                trace_height = args.trace_height_tol,
+                registration = args.registration_tol,
+            )
+
+            report = ToleranceReport(
+                desc,
+                tolerances,
+                samples = args.samples,
+                batch_size = args.batch_size,
+                workers = args.jobs,
+                seed = args.seed,
+                progress = lambda done: print(f'\rSimulated {done}/{args.samples} coils', end=''),
+            )
+            print()
+
+            print(f'\n    {coil.analysis_title()}\n')
+            print('    Percentile  ' + ''.join(f'{output.capitalize():>14}' for output in OUTPUTS))
+            for q, row in zip(args.percentiles, report.percentiles(args.percentiles)):
+                print(f'    {q:>9g}%  ' + ''.join(f'{v * 1000:>11.7f} mT' for v in row))
+
+            # Slopes are in Tesla per mm, which is numerically equal to mT per µm
+            slopes, standardized = report.sensitivities()
+            print('\n    Sensitivity (mT per µm, standardized coefficient in brackets)\n')
+            print('    Parameter     ' + ''.join(f'{output.capitalize():>24}' for output in OUTPUTS))
+            for param, slope_row, std_row in zip(PARAMS, slopes, standardized):
+                print(f'    {param:<14}' + ''.join(f'{s:>14.2e} ({c:>+6.3f})' for s, c in zip(slope_row, std_row)))
+            print()
+
         case 'optimize':
             base = json.load(open(args.file))
             
             lower = args.lower
             upper = args.upper
-            x = lower
             
             best_json = None
             max = -1e99
+            rejections = Counter()
 
             def replace_var(json, x):
                 copy = deepcopy(json)
@@ -226,8 +453,23 @@ if __name__ == '__main__':
                 return copy
 
             for i in range(args.steps):
+                x = lower + i * (upper - lower) / args.steps
                 new = replace_var(base, x)
-                coil = Coil(new)
+                if new['turns'] < 1:
+                    rejections[REASON_DEGENERATE] += 1
+                    continue
+
+                try:
+                    coil = Coil(new)
+                except (IndexError, ValueError, ZeroDivisionError):
+                    rejections[REASON_DEGENERATE] += 1
+                    continue
+
+                validity = ValidityReport(coil, spacing_tolerance = args.spacing_tolerance)
+                if not validity.valid:
+                    rejections.update(validity.violations.keys())
+                    continue
+
                 field = DiscreteFieldReport(coil)
                 
                 measure = -1e99
@@ -245,7 +487,12 @@ if __name__ == '__main__':
 
                 print(f'\rMax: {max * 1000:.4f}mT - {measure * 1000:.4f}mT', end='')
 
-                x += (upper - lower) / args.steps
+            if rejections:
+                print(f'\nRejected invalid candidates: {", ".join(f"{reason}: {count}" for reason, count in sorted(rejections.items()))}')
+
+            if best_json is None:
+                print('ERROR: No valid coil design found in the given range')
+                sys.exit(1)
             
             best = Coil(best_json)
             field = DiscreteFieldReport(best)
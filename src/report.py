@@ -14,6 +14,21 @@ SENSOR_POS_DIAGONAL =   (CHESS_SQUARE_SIZE / 2, CHESS_SQUARE_SIZE / 2)
 
 DFLT_OBSERVER_HEIGHT = 3 / 1000
 
+# Get the lateral, center, and diagonal sensor positions at the given height above a coil
+def sensor_positions(observer_height: float = DFLT_OBSERVER_HEIGHT):
+    lateral = []
+    for v in (1, -1):
+        lateral.extend([
+            np.array([SENSOR_POS_LATERAL[0] * v, observer_height, 0]),
+            np.array([0, observer_height, SENSOR_POS_LATERAL[0] * v]),
+        ])
+    center = np.array([SENSOR_POS_CENTER[0], observer_height, SENSOR_POS_CENTER[1]])
+    diagonal = [
+        np.array([SENSOR_POS_DIAGONAL[0] * x, observer_height, SENSOR_POS_DIAGONAL[1] * y])
+        for x in (1, -1) for y in (1, -1)
+    ]
+    return lateral, center, diagonal
+
 # Fast to generate report on field strength at the center, lateral, and diagonal positions
 class DiscreteFieldReport(object):
     def __init__(
@@ -24,17 +39,7 @@ class DiscreteFieldReport(object):
         model = coil.simulation_model()
         self.observer_height = observer_height
 
-        self.sensor_pos_lateral = []
-        for v in (1, -1):
-            self.sensor_pos_lateral.extend([
-                np.array([SENSOR_POS_LATERAL[0] * v, self.observer_height, 0]),
-                np.array([0, self.observer_height, SENSOR_POS_LATERAL[0] * v]),
-            ])
-        self.sensor_pos_center = np.array([SENSOR_POS_CENTER[0], self.observer_height, SENSOR_POS_CENTER[1]])
-        self.sensor_pos_diagonal = [
-            np.array([SENSOR_POS_DIAGONAL[0] * x, self.observer_height, SENSOR_POS_DIAGONAL[1] * y])
-            for x in (1, -1) for y in (1, -1)
-        ]
+        self.sensor_pos_lateral, self.sensor_pos_center, self.sensor_pos_diagonal = sensor_positions(self.observer_height)
 
         self.laterals =  [Sensor(pos).getB(model) for pos in self.sensor_pos_lateral ]
         self.center =     Sensor(self.sensor_pos_center).getB(model)
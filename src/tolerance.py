@@ -0,0 +1,147 @@
+
+# Monte Carlo analysis of how PCB manufacturing tolerances spread a coil's centering field strengths
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import magpylib
+import numpy as np
+from numpy.typing import NDArray
+
+from coil import Coil
+from constants import COPPER_RESISTIVITY
+from report import DFLT_OBSERVER_HEIGHT, sensor_positions
+
+PARAM_TRACE_WIDTH = 'trace_width'
+PARAM_TRACE_HEIGHT = 'trace_height'
+PARAM_REGISTRATION = 'registration'
+PARAMS = [PARAM_TRACE_WIDTH, PARAM_TRACE_HEIGHT, PARAM_REGISTRATION]
+
+OUTPUT_CENTER = 'center'
+OUTPUT_LATERAL = 'lateral'
+OUTPUT_DIAGONAL = 'diagonal'
+OUTPUTS = [OUTPUT_CENTER, OUTPUT_LATERAL, OUTPUT_DIAGONAL]
+
+# One standard deviation of each manufacturing parameter, all in mm like the coil descriptor
+# Etching changes the copper width but not the artwork's pitch, so spacing is the pitch less the etched width and is
+# not varied on its own; trace centerlines and the layer stack stay at their nominal positions
+class Tolerances(object):
+    def __init__(
+            self,
+            trace_width: float = 0.01,
+            trace_height: float = 0.0035,
+            registration: float = 0.025,
+        ) -> None:
+        self.trace_width = trace_width
+        self.trace_height = trace_height
+        self.registration = registration
+
+# Draw manufactured variations of a coil
+# Width and copper thickness only change the trace resistance, and with it the drive current of a power-driven coil
+# Returns the drive current of each sample in Amperes, per-layer (x, y) registration offsets in meters with the first
+# layer as the reference, and an (N, len(PARAMS)) array of the sampled parameters in mm with registration as the mean
+# layer offset
+def sample_variations(coil: Coil, desc, tolerances: Tolerances, samples: int, rng: np.random.Generator):
+    nominal_width = coil.trace_width * 1000
+    nominal_height = coil.trace_height * 1000
+    trace_width = rng.normal(nominal_width, tolerances.trace_width, samples)
+    trace_height = rng.normal(nominal_height, tolerances.trace_height, samples)
+
+    # Keep dimensions physical even for wide tolerances
+    trace_width = np.maximum(trace_width, nominal_width * 0.01)
+    trace_height = np.maximum(trace_height, nominal_height * 0.01)
+
+    if 'current' in desc:
+        currents = np.full(samples, float(desc['current']))
+    else:
+        resistance = COPPER_RESISTIVITY * coil.length / (trace_width / 1000 * trace_height / 1000)
+        currents = np.sqrt(desc['power'] / resistance)
+
+    offsets = rng.normal(0, tolerances.registration, (samples, coil.layers, 2))
+    offsets[:, 0] = 0
+    registration = np.mean(np.linalg.norm(offsets[:, 1:], axis=-1), axis=-1) if coil.layers > 1 else np.zeros(samples)
+
+    params = np.stack([trace_width, trace_height, registration], axis=-1)
+    return currents, offsets / 1000, params
+
+# Get the center magnitude and lateral and diagonal centering strengths in Tesla for a batch of variations of a design
+# All coils of the batch are evaluated at every sensor position in a single field computation
+def evaluate_batch(desc, currents: NDArray, offsets: NDArray, observer_height: float = DFLT_OBSERVER_HEIGHT) -> NDArray:
+    lateral, center, diagonal = sensor_positions(observer_height)
+    positions = np.array([center, *lateral, *diagonal])
+
+    coil = Coil(desc)
+    models = []
+    for current, layer_offsets in zip(currents, offsets):
+        model = coil.simulation_model(layer_offsets)
+        model.current = current
+        models.append(model)
+    B = magpylib.getB(models, positions, squeeze=False).reshape(len(models), len(positions), 3)
+
+    # Unit vectors pointing from each sensor to the center, the center sensor itself has no centering direction
+    towards = center - positions[1:]
+    towards /= np.linalg.norm(towards, axis=-1, keepdims=True)
+    centering = np.abs(np.einsum('nsd,sd->ns', B[:, 1:], towards))
+
+    return np.stack([
+        np.linalg.norm(B[:, 0], axis=-1),
+        np.max(centering[:, :len(lateral)], axis=-1),
+        np.max(centering[:, len(lateral):], axis=-1),
+    ], axis=-1)
+
+def _evaluate_job(job) -> NDArray:
+    return evaluate_batch(*job)
+
+# Distribution of centering strengths over randomly manufactured copies of a coil design
+class ToleranceReport(object):
+    def __init__(
+            self,
+            desc,
+            tolerances: Tolerances,
+            samples: int = 1000,
+            batch_size: int = 100,
+            workers: Optional[int] = None,
+            seed: Optional[int] = None,
+            observer_height: float = DFLT_OBSERVER_HEIGHT,
+            progress: Optional[Callable[[int], None]] = None,
+        ) -> None:
+        rng = np.random.default_rng(seed)
+        currents, offsets, self.params = sample_variations(Coil(desc), desc, tolerances, samples, rng)
+
+        jobs = [
+            (desc, currents[start:start + batch_size], offsets[start:start + batch_size], observer_height)
+            for start in range(0, samples, batch_size)
+        ]
+
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(_evaluate_job, jobs):
+                results.append(result)
+                if progress is not None:
+                    progress(sum(len(r) for r in results))
+
+        # (N, len(OUTPUTS)) array of center, lateral, and diagonal strengths in Tesla
+        self.outputs = np.concatenate(results)
+
+    # Get an (len(q), len(OUTPUTS)) array of the given percentiles of each output
+    def percentiles(self, q) -> NDArray:
+        return np.percentile(self.outputs, q, axis=0)
+
+    # Fit a linear model of each output against each parameter
+    # Returns (slopes, standardized) arrays of shape (len(PARAMS), len(OUTPUTS)); slopes are in Tesla per mm and
+    # standardized coefficients are the output change in standard deviations per standard deviation of the parameter
+    # Parameters that were not varied have NaN sensitivities
+    def sensitivities(self) -> tuple[NDArray, NDArray]:
+        param_std = np.std(self.params, axis=0)
+        output_std = np.std(self.outputs, axis=0)
+        varied = param_std > 0
+
+        slopes = np.full((len(PARAMS), len(OUTPUTS)), np.nan)
+        if np.any(varied):
+            X = self.params[:, varied] - np.mean(self.params[:, varied], axis=0)
+            Y = self.outputs - np.mean(self.outputs, axis=0)
+            slopes[varied] = np.linalg.lstsq(X, Y, rcond=None)[0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            standardized = slopes * param_std[:, None] / output_std[None, :]
+        return slopes, standardized
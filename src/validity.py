@@ -0,0 +1,191 @@
+
+# Geometric design rule checks for a coil's spiral trace, cheap enough to run before any field simulation
+
+from collections import Counter
+from itertools import product
+
+import numpy as np
+from numpy.typing import NDArray
+
+from coil import Coil
+from constants import CHESS_SQUARE_SIZE
+
+REASON_DEGENERATE = 'degenerate'
+REASON_INTERSECTION = 'intersection'
+REASON_SHORT = 'short'
+REASON_SPACING = 'spacing'
+REASON_FOOTPRINT = 'footprint'
+# Violations that make a footprint unusable, as opposed to a clearance shortfall
+FATAL_REASONS = [REASON_DEGENERATE, REASON_INTERSECTION, REASON_SHORT, REASON_FOOTPRINT]
+
+# Slack in meters allowed on the footprint limit and when detecting shorts, absorbs floating point error
+DISTANCE_TOLERANCE = 1 / 1_000_000
+# Segments closer than this many clearances along the trace are parts of the same stretch of conductor rather than
+# neighbouring turns, covers points straddling a corner of up to 90 degrees without flagging the corner itself
+SAME_CONDUCTOR_PATH = np.pi / 2
+
+# Get the distance between each pair of 2D segments (a0, a1) and (b0, b1), given as (N, 2) arrays
+def segment_distances(a0: NDArray, a1: NDArray, b0: NDArray, b1: NDArray) -> NDArray:
+    def cross(u, v):
+        return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+    def point_distance(p, s0, s1):
+        d = s1 - s0
+        length_sq = np.sum(d ** 2, axis=-1)
+        t = np.divide(np.sum((p - s0) * d, axis=-1), length_sq, out=np.zeros_like(length_sq), where=length_sq > 0)
+        closest = s0 + np.clip(t, 0, 1)[:, None] * d
+        return np.sqrt(np.sum((p - closest) ** 2, axis=-1))
+
+    da = a1 - a0
+    db = b1 - b0
+    crossing = (
+        (np.sign(cross(da, b0 - a0)) * np.sign(cross(da, b1 - a0)) < 0) &
+        (np.sign(cross(db, a0 - b0)) * np.sign(cross(db, a1 - b0)) < 0)
+    )
+
+    dist = np.minimum.reduce([
+        point_distance(a0, b0, b1),
+        point_distance(a1, b0, b1),
+        point_distance(b0, a0, a1),
+        point_distance(b1, a0, a1),
+    ])
+    dist[crossing] = 0
+    return dist
+
+# Get all pairs of distinct segments that come within `reach` of each other
+# Segments are rasterized into a uniform grid of cells so only segments sharing a cell are paired
+def candidate_pairs(start: NDArray, end: NDArray, reach: float) -> NDArray:
+    lengths = np.sqrt(np.sum((end - start) ** 2, axis=-1))
+    cell = max(2 * reach, float(np.mean(lengths)) / 8)
+
+    # Sample points at most half a cell apart along each segment, every point of the segment is then within a
+    # quarter cell of a sample and the cells within `halfwidth` of the samples cover its `reach / 2` neighbourhood
+    samples = np.maximum(np.ceil(lengths / (cell / 2)).astype(int) + 1, 2)
+    seg = np.repeat(np.arange(len(start)), samples)
+    offset = np.arange(len(seg)) - np.repeat(np.cumsum(samples) - samples, samples)
+    t = (offset / (samples[seg] - 1))[:, None]
+    points = start[seg] + t * (end[seg] - start[seg])
+
+    halfwidth = reach / 2 + cell / 4
+    lo = np.floor((points - halfwidth) / cell).astype(np.int64)
+    hi = np.floor((points + halfwidth) / cell).astype(np.int64)
+
+    # The box around each sample is at most 1.5 cells wide so spans no more than 3 cells per axis
+    keys, members = [], []
+    for dx, dy in product(range(3), range(3)):
+        inside = (lo[:, 0] + dx <= hi[:, 0]) & (lo[:, 1] + dy <= hi[:, 1])
+        keys.append(np.stack([lo[inside, 0] + dx, lo[inside, 1] + dy], axis=-1))
+        members.append(seg[inside])
+
+    # Pack each (cell, segment) entry into one integer so duplicates can be removed with a fast 1D sort
+    keys = np.concatenate(keys)
+    keys -= np.min(keys, axis=0)
+    rows = int(np.max(keys[:, 1])) + 1
+    cells = keys[:, 0] * rows + keys[:, 1]
+    entries = np.unique(cells * len(start) + np.concatenate(members))
+    cells, members = entries // len(start), entries % len(start)
+
+    # Entries are sorted by cell, so pair each entry with those following it in the same cell
+    pairs = []
+    d = 1
+    while d < len(members):
+        same = cells[d:] == cells[:-d]
+        if not np.any(same):
+            break
+        pairs.append(np.stack([members[:-d][same], members[d:][same]], axis=-1))
+        d += 1
+
+    if not pairs:
+        return np.empty((0, 2), dtype=int)
+
+    pairs = np.concatenate(pairs)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    packed = np.unique(np.min(pairs, axis=-1) * len(start) + np.max(pairs, axis=-1))
+    return np.stack([packed // len(start), packed % len(start)], axis=-1)
+
+# Get the fraction of the nominal pitch that separates each segment from the same segment one turn further out
+# `Coil` steps each vertex outward by the pitch along its miter vector and ramps the step with the vertex angle, so
+# segments are tilted slightly against the base polygon and the miter step projects to a little less than a full pitch
+# onto their normals. The generator places adjacent turns this far apart by construction, so clearance is judged
+# against it rather than the nominal pitch
+def pitch_factors(coil: Coil, start: NDArray, end: NDArray) -> NDArray:
+    pitch = coil.trace_width + coil.spacing
+    stride = len(coil.base_verts)
+    factors = np.ones(len(start))
+    if len(coil.verts) != coil.turns * stride or coil.turns < 2:
+        return factors
+
+    verts = np.asarray(coil.verts, dtype=np.float64)
+    # Step from each vertex to the same vertex one turn out, the outermost turn reuses the step from the turn inside it
+    steps = np.empty_like(verts)
+    steps[:-stride] = verts[stride:] - verts[:-stride]
+    steps[-stride:] = steps[-2 * stride:-stride]
+
+    direction = end - start
+    lengths = np.sqrt(np.sum(direction ** 2, axis=-1))
+    moving = lengths > 0
+    normals = np.stack([-direction[moving, 1], direction[moving, 0]], axis=-1) / lengths[moving, None]
+    # Adjacent turns are not exactly parallel as each end steps along its own miter, take the nearer end
+    projected = np.minimum(
+        np.abs(np.sum(steps[:-1][moving] * normals, axis=-1)),
+        np.abs(np.sum(steps[1:][moving] * normals, axis=-1)),
+    )
+    factors[moving] = np.minimum(projected / pitch, 1)
+    return factors
+
+# Result of checking a coil against trace clearance and footprint rules
+# `spacing_tolerance` is an extra fraction of `spacing` that gaps between turns may fall short by when screening
+class ValidityReport(object):
+    def __init__(self, coil: Coil, spacing_tolerance: float = 0.0) -> None:
+        # Number of offending segment pairs (or a single count for whole-coil problems) per reason
+        self.violations: Counter[str] = Counter()
+        self.min_distance = float('inf')
+
+        verts = np.asarray(coil.verts, dtype=np.float64)
+        if verts.ndim != 2 or len(verts) < 2 or not np.all(np.isfinite(verts)):
+            self.violations[REASON_DEGENERATE] += 1
+            return
+
+        extent = np.max(verts, axis=0) - np.min(verts, axis=0) + coil.trace_width
+        if np.any(extent > CHESS_SQUARE_SIZE + DISTANCE_TOLERANCE):
+            self.violations[REASON_FOOTPRINT] += 1
+
+        clearance = coil.trace_width + coil.spacing
+        start, end = verts[:-1], verts[1:]
+        pairs = candidate_pairs(start, end, clearance)
+
+        # Only compare segments far enough apart along the trace to belong to different turns, zero length segments
+        # are skipped as the segments either side of them cover the same point
+        lengths = np.sqrt(np.sum((end - start) ** 2, axis=-1))
+        path = np.concatenate([[0], np.cumsum(lengths)])
+        pairs = pairs[path[pairs[:, 1]] - path[pairs[:, 0] + 1] >= clearance * SAME_CONDUCTOR_PATH]
+        pairs = pairs[(lengths[pairs[:, 0]] > 0) & (lengths[pairs[:, 1]] > 0)]
+        if len(pairs) == 0:
+            return
+
+        i, j = pairs[:, 0], pairs[:, 1]
+        dist = segment_distances(start[i], end[i], start[j], end[j])
+        self.min_distance = float(np.min(dist))
+
+        factors = pitch_factors(coil, start, end)
+        required = clearance * np.minimum(factors[i], factors[j]) - coil.spacing * spacing_tolerance
+
+        intersecting = dist <= 0
+        shorted = ~intersecting & (dist < coil.trace_width - DISTANCE_TOLERANCE)
+        too_close = ~intersecting & ~shorted & (dist < required - DISTANCE_TOLERANCE)
+        for reason, mask in ((REASON_INTERSECTION, intersecting), (REASON_SHORT, shorted), (REASON_SPACING, too_close)):
+            if np.any(mask):
+                self.violations[reason] += int(np.count_nonzero(mask))
+
+    @property
+    def valid(self) -> bool:
+        return not self.violations
+
+    # Whether the coil has any violation other than a spacing shortfall
+    @property
+    def fatal(self) -> bool:
+        return any(reason in self.violations for reason in FATAL_REASONS)
+
+    # Get a human readable list of every rule the coil violates
+    def describe(self) -> list[str]:
+        return [f'{reason}: {count}' for reason, count in sorted(self.violations.items())]